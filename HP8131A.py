@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
 import tango
-from tango import AttrWriteType, DevState, DispLevel
+from tango import AttrWriteType, DevState, DispLevel, GreenMode
 from tango.server import Device, attribute, command, device_property
 
-import pyvisa, time
+import asyncio, pyvisa, time
+from contextlib import asynccontextmanager
 from enum import IntEnum
 
 
@@ -42,6 +43,127 @@ attr2gpib = dict(
 
 gpib2attr = {v: k for k, v in attr2gpib.items()}
 
+# cached attribute values younger than FRESH_TTL (in s) are served directly,
+# values younger than STALE_TTL are served while being refreshed in background
+FRESH_TTL = 1.0
+STALE_TTL = 10.0
+# attributes are polled by the Tango polling thread (in ms), clients should
+# subscribe to change events instead of polling the device themselves
+POLL_PERIOD = 1000
+# the self-test takes much longer than the regular I/O timeout (in ms)
+SELFTEST_TIMEOUT = 20000
+
+_BOOLS = ('enabled1', 'cenabled1', 'enabled2', 'cenabled2', 'trigger_external')
+_ENUMS = dict(trigger_mode=TriggerMode, trigger_slope=TriggerSlope)
+
+
+_BOOL_STR = {True: 'ON', False: 'OFF'}
+
+
+def _to_bool(ans):
+    return ans in ('ON', '1')
+
+
+# query strings, write prefixes and response parsers per attribute,
+# parsers default to float
+_CMDS = {name: gpib + '?' for name, gpib in attr2gpib.items()}
+_WRITE_PREFIX = {name: gpib + ' ' for name, gpib in attr2gpib.items()}
+_PARSERS = {name: _to_bool for name in _BOOLS}
+_PARSERS.update({name: enum.__getitem__ for name, enum in _ENUMS.items()})
+
+
+def _short_form(header):
+    '''Reduce a SCPI header to uppercase short form without leading colon'''
+    nodes = []
+    for node in header.upper().lstrip(':').split(':'):
+        mnemonic = node.rstrip('0123456789')
+        suffix = node[len(mnemonic):]
+        if len(mnemonic) > 4:
+            # first four letters, or three if the fourth is a vowel
+            mnemonic = mnemonic[:3] if mnemonic[3] in 'AEIOU' else mnemonic[:4]
+        nodes.append(mnemonic + suffix)
+    return ':'.join(nodes)
+
+
+_SHORT2ATTR = {_short_form(gpib): name for name, gpib in attr2gpib.items()}
+# common commands that do not change any setting
+_NO_SETTINGS = ('*TRG', '*CLS', '*WAI')
+
+
+def _parse_learn(lrn):
+    '''Map the ":HEADER VALUE;..." items of a learn string to attributes'''
+    values = {}
+    for item in lrn.split(';'):
+        header, _, ans = item.strip().partition(' ')
+        name = _SHORT2ATTR.get(_short_form(header))
+        if name is None:
+            continue
+        try:
+            values[name] = _PARSERS.get(name, float)(ans.strip())
+        except (KeyError, ValueError):
+            pass
+    return values
+
+
+def _from_str(name, text):
+    '''Convert a user supplied string to the value type of attribute name'''
+    if name in _BOOLS:
+        text = text.upper()
+        if text not in ('1', 'ON', 'TRUE', '0', 'OFF', 'FALSE'):
+            raise ValueError(f'Invalid boolean for {name}: {text}')
+        return text in ('1', 'ON', 'TRUE')
+    elif name in _ENUMS:
+        enum = _ENUMS[name]
+        try:
+            return enum[text.upper()]
+        except KeyError:
+            raise ValueError(f'Invalid value for {name}: {text}, allowed: '
+                             f'{", ".join(enum.__members__)}') from None
+    else:
+        return float(text)
+
+
+def _limit(text, default):
+    try:
+        return float(text)
+    except ValueError:  # 'Not specified'
+        return default
+
+
+_RM = None
+
+
+def _get_rm():
+    '''Return the ResourceManager shared by all devices of this server'''
+    global _RM
+    if _RM is None:
+        _RM = pyvisa.ResourceManager('@py')
+    return _RM
+
+
+def _make_writer(name):
+    '''Create the write method for attribute name
+
+    Command prefix, value conversion and formatting are chosen once here,
+    not on every write.
+    '''
+    prefix = _WRITE_PREFIX[name]
+    if name in _BOOLS:
+        async def write(self, value):
+            value = bool(value)
+            await self._set(name, value, prefix + _BOOL_STR[value])
+    elif name in _ENUMS:
+        enum = _ENUMS[name]
+        async def write(self, value):
+            value = enum(value)
+            await self._set(name, value, prefix + value.name)
+    else:
+        async def write(self, value):
+            await self._set(name, value, prefix + str(value))
+    write.__name__ = f'write_{name}'
+    return write
+
+
 class HP8131A(Device):
     '''HP8131A
 
@@ -49,6 +171,8 @@ class HP8131A(Device):
     Works transparently for regular GPIB connections as well as for USB-GPIB
     adapters that expose the GPIB interface as a serial device.
     '''
+    green_mode = GreenMode.Asyncio
+
     visa_resource = device_property(
         dtype=str,
         default_value='ASRL/dev/ttyUSB0::INSTR',
@@ -64,6 +188,7 @@ class HP8131A(Device):
         unit='s', min_value=2e-9, max_value=99.9e-3,
         format='8.3e',
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     low1 = attribute(
@@ -72,6 +197,7 @@ class HP8131A(Device):
         access=AttrWriteType.READ_WRITE,
         unit='V', min_value=-5, max_value=4.9,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     high1 = attribute(
@@ -80,6 +206,7 @@ class HP8131A(Device):
         access=AttrWriteType.READ_WRITE,
         unit='V', min_value=-4.9, max_value=5,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     delay1 = attribute(
@@ -89,6 +216,7 @@ class HP8131A(Device):
         unit='s', min_value=0, max_value=99.9e-3,
         format='8.3e',
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     width1 = attribute(
@@ -98,6 +226,7 @@ class HP8131A(Device):
         unit='s', min_value=0.5e-9, max_value=99.9e-3,
         format='8.3e',
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     enabled1 = attribute(
@@ -105,6 +234,7 @@ class HP8131A(Device):
         dtype=bool,
         access=AttrWriteType.READ_WRITE,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
     
     cenabled1 = attribute(
@@ -112,6 +242,7 @@ class HP8131A(Device):
         dtype=bool,
         access=AttrWriteType.READ_WRITE,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     low2 = attribute(
@@ -120,6 +251,7 @@ class HP8131A(Device):
         access=AttrWriteType.READ_WRITE,
         unit='V', min_value=-5, max_value=4.9,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
     
     high2 = attribute(
@@ -128,6 +260,7 @@ class HP8131A(Device):
         access=AttrWriteType.READ_WRITE,
         unit='V', min_value=-4.9, max_value=5,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
     
     delay2 = attribute(
@@ -137,6 +270,7 @@ class HP8131A(Device):
         unit='s', min_value=0, max_value=99.9e-3,
         format='8.3e',
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     width2 = attribute(
@@ -146,6 +280,7 @@ class HP8131A(Device):
         unit='s', min_value=0.5e-9, max_value=99.9e-3,
         format='8.3e',
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     enabled2 = attribute(
@@ -153,6 +288,7 @@ class HP8131A(Device):
         dtype=bool,
         access=AttrWriteType.READ_WRITE,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
     
     cenabled2 = attribute(
@@ -160,6 +296,7 @@ class HP8131A(Device):
         dtype=bool,
         access=AttrWriteType.READ_WRITE,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     trigger_mode = attribute(
@@ -167,6 +304,7 @@ class HP8131A(Device):
         dtype=TriggerMode,
         access=AttrWriteType.READ_WRITE,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     trigger_slope = attribute(
@@ -174,6 +312,7 @@ class HP8131A(Device):
         dtype=TriggerSlope,
         access=AttrWriteType.READ_WRITE,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     trigger_external = attribute(
@@ -181,6 +320,7 @@ class HP8131A(Device):
         dtype=bool,
         access=AttrWriteType.READ_WRITE,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
 
     trigger_level = attribute(
@@ -189,137 +329,262 @@ class HP8131A(Device):
         access=AttrWriteType.READ_WRITE,
         unit='V', min_value=-5, max_value=5,
         fget='read_general',
+        polling_period=POLL_PERIOD,
     )
     
 
-    def init_device(self):
-        super(HP8131A, self).init_device()
+    async def init_device(self):
+        await super(HP8131A, self).init_device()
+        self._cache = {}
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+        self._pending = None
+        self._use_lrn = True
+        self.dev = None
+        self._logger = self.get_logger()
+        for name in attr2gpib:
+            # events are pushed by _store() whenever a value changes
+            self.set_change_event(name, True, False)
         try:
             self.info_stream('Trying to connect to HP8131A on '
                              f'{self.visa_resource}')
-            self.rm = pyvisa.ResourceManager('@py')
-            self.dev = self.rm.open_resource(self.visa_resource)
+            self.rm = _get_rm()
+            self.dev = self.rm.open_resource(self.visa_resource,
+                                             query_delay=0)
             self.dev.read_termination = '\n'
             self.dev.write_termination = '\n'
-            idn = self.write_read('*IDN?')
+            if self.visa_resource.startswith('ASRL'):
+                self.info_stream('Serial USB-GPIB adapters are slow with '
+                                 'pyvisa-py, consider a linux-gpib interface '
+                                 'with resource "GPIB::<address>::INSTR"')
+            idn = await self._query('*IDN?')
             self.info_stream(f'Connection established on {self.visa_resource}:'
                              f'\n{idn}')
             self.set_state(DevState.ON)
-        except Exception as ex:
+        except (pyvisa.errors.Error, OSError, ValueError) as ex:
             self.error_stream(f'Error on initialization: {ex}')
             self.set_state(DevState.OFF)
         
 
-    @command(dtype_in=str, doc_in='command', dtype_out=str, doc_out='response')
-    def write_read(self, msg: str) -> str:
-        ans = self.dev.query(msg)
-        self.debug_stream(ans)
+    def _check_connected(self):
+        if self.dev is None:
+            raise RuntimeError('HP8131A not connected, run Init')
+
+    async def _io(self, func, *args):
+        '''Run a blocking pyvisa call in an executor, one call at a time'''
+        self._check_connected()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, func, *args)
+
+    def _transact(self, msg, timeout=None):
+        # plain write and read, without pyvisa's query delay handling;
+        # setting the timeout reconfigures the transport, so only on request
+        if timeout is None:
+            self.dev.write(msg)
+            return self.dev.read()
+        default, self.dev.timeout = self.dev.timeout, timeout
+        try:
+            self.dev.write(msg)
+            return self.dev.read()
+        finally:
+            self.dev.timeout = default
+
+    def _send(self, msg):
+        self.dev.write(msg)
+
+    async def _query(self, msg, timeout=None):
+        ans = await self._io(self._transact, msg, timeout)
+        if self._logger.is_debug_enabled():
+            self.debug_stream(ans)
         return ans
+
+    async def _write(self, msg):
+        if self._logger.is_debug_enabled():
+            self.debug_stream(msg)
+        await self._io(self._send, msg)
+        # invalidate cached values of all attributes touched by msg, or all
+        # of them if msg contains anything else (e.g. *RST, *RCL)
+        for part in msg.split(';'):
+            header = part.strip().split(' ')[0]
+            if header.upper() in _NO_SETTINGS:
+                continue
+            name = _SHORT2ATTR.get(_short_form(header))
+            if name is None:
+                self._cache.clear()
+                break
+            self._cache.pop(name, None)
+
+    @command(dtype_in=str, doc_in='command', dtype_out=str, doc_out='response')
+    async def write_read(self, msg: str) -> str:
+        return await self._query(msg)
     
     @command(dtype_in=str, doc_in='command', dtype_out=None)
-    def write(self, msg: str):
-        self.debug_stream(msg)
-        self.dev.write(msg)
+    async def write(self, msg: str):
+        await self._write(msg)
+
+    async def read_many(self, names):
+        '''Read several attributes with a single compound SCPI query'''
+        cmd = ';'.join(_CMDS[name] for name in names)
+        response = await self._query(cmd)
+        answers = response.split(';')
+        if len(answers) != len(names):
+            raise ValueError(f'Expected {len(names)} answers to {cmd!r}, '
+                             f'got {response!r}')
+        now = time.monotonic()
+        values = {name: _PARSERS.get(name, float)(ans)
+                  for name, ans in zip(names, answers)}
+        for name, value in values.items():
+            self._store(name, value, now)
+        return values
+
+    def _store(self, name, value, ts):
+        '''Cache a value and push a change event if it differs'''
+        old = self._cache.get(name)
+        self._cache[name] = (ts, value)
+        if old is None or old[1] != value:
+            self.push_change_event(name, value)
+
+    async def _full_refresh(self):
+        '''Read all attributes, preferably from the learn string (*LRN?)
 
-    def read_general(self, attr):
+        Attributes missing in the learn string are read with a compound
+        query. Unless the learn string covers all attributes, it is not
+        requested again, so later refreshes cost a single compound query.
+        '''
+        values = {}
+        if self._use_lrn:
+            try:
+                lrn = await self._query('*LRN?')
+            except (pyvisa.VisaIOError, ValueError) as ex:
+                lrn = ''
+                self.info_stream(f'Learn string not available: {ex}')
+                # drop the error the rejected query left in the error queue
+                await self._io(self._send, '*CLS')
+            now = time.monotonic()
+            values = _parse_learn(lrn)
+            for name, value in values.items():
+                self._store(name, value, now)
+            self._use_lrn = len(values) == len(attr2gpib)
+        missing = [name for name in attr2gpib if name not in values]
+        if missing:
+            values.update(await self.read_many(missing))
+        return values
+
+    def _refresh(self):
+        '''Start re-reading all attributes unless a refresh is running'''
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._full_refresh())
+            self._refresh_task.add_done_callback(self._refresh_done)
+        return self._refresh_task
+
+    def _refresh_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.error_stream(f'Error on cache refresh: {task.exception()}')
+
+    async def read_general(self, attr):
+        # fail before scheduling a refresh that would only log the same error
+        self._check_connected()
         name = attr.get_name()
-        cmd = attr2gpib[name] + '?'
-        ans = self.write_read(cmd)
-        if name in ['enabled1', 'cenabled1', 'enabled2', 'cenabled2',
-                    'trigger_external']:
-            value = True if ans == 'ON' else False
-        elif name == 'trigger_mode':
-            value = TriggerMode[ans]
-        elif name == 'trigger_slope':
-            value = TriggerSlope[ans]
-        else:
-            value = float(ans)
-        self.debug_stream(f'READ: {name} = {value}')
+        ts, value = self._cache.get(name, (float('-inf'), None))
+        age = time.monotonic() - ts
+        if age >= STALE_TTL:
+            value = (await self._refresh())[name]
+        elif age >= FRESH_TTL:
+            # serve the stale value, refresh for the next read
+            self._refresh()
+        if self._logger.is_debug_enabled():
+            self.debug_stream(f'READ: {name} = {value}')
         attr.set_value(value)
         return value
     
-    def write_period(self, value):
-        cmd = f'{attr2gpib["period"]} {value}'
-        self.write(cmd)
-    
-    def write_low1(self, value):
-        cmd = f'{attr2gpib["low1"]} {value}'
-        self.write(cmd)
-    
-    def write_high1(self, value):
-        cmd = f'{attr2gpib["high1"]} {value}'
-        self.write(cmd)
-    
-    def write_delay1(self, value):
-        cmd = f'{attr2gpib["delay1"]} {value}'
-        self.write(cmd)
-    
-    def write_width1(self, value):
-        cmd = f'{attr2gpib["width1"]} {value}'
-        self.write(cmd)
-    
-    def write_enabled1(self, value):
-        cmd = f'{attr2gpib["enabled1"]} {int(value)}'
-        self.write(cmd)
-    
-    def write_cenabled1(self, value):
-        cmd = f'{attr2gpib["cenabled1"]} {int(value)}'
-        self.write(cmd)
-    
-    def write_low2(self, value):
-        cmd = f'{attr2gpib["low2"]} {value}'
-        self.write(cmd)
-    
-    def write_high2(self, value):
-        cmd = f'{attr2gpib["high2"]} {value}'
-        self.write(cmd)
-    
-    def write_delay2(self, value):
-        cmd = f'{attr2gpib["delay2"]} {value}'
-        self.write(cmd)
-    
-    def write_width2(self, value):
-        cmd = f'{attr2gpib["width2"]} {value}'
-        self.write(cmd)
-    
-    def write_enabled2(self, value):
-        cmd = f'{attr2gpib["enabled2"]} {int(value)}'
-        self.write(cmd)
+    async def _set(self, name, value, cmd):
+        '''Write a setting and cache it, as the instrument accepts it as sent'''
+        if self._pending is not None:
+            self._pending.append((name, value, cmd))
+        else:
+            await self._write(cmd)
+            self._store(name, value, time.monotonic())
 
-    def write_cenabled2(self, value):
-        cmd = f'{attr2gpib["cenabled2"]} {int(value)}'
-        self.write(cmd)
-    
-    def write_trigger_level(self, value):
-        cmd = f'{attr2gpib["trigger_level"]} {value}'
-        self.write(cmd)
-    
-    def write_trigger_mode(self, value):
-        val_str = TriggerMode(value).name
-        cmd = f'{attr2gpib["trigger_mode"]} {val_str}'
-        self.write(cmd)
-    
-    def write_trigger_slope(self, value):
-        val_str = TriggerSlope(value).name
-        cmd = f'{attr2gpib["trigger_slope"]} {val_str}'
-        self.write(cmd)
-    
-    def write_trigger_external(self, value):
-        cmd = f'{attr2gpib["trigger_external"]} {int(value)}'
-        self.write(cmd)
+    @asynccontextmanager
+    async def batch(self):
+        '''Collect attribute writes and send them as one compound command'''
+        self._pending = []
+        try:
+            yield
+            await self._flush_batch()
+        finally:
+            self._pending = None
+
+    async def _flush_batch(self):
+        '''Send the writes collected by batch() so far and end batching'''
+        pending, self._pending = self._pending, None
+        if pending:
+            await self._write(';'.join(cmd for _, _, cmd in pending))
+            now = time.monotonic()
+            for name, value, _ in pending:
+                self._store(name, value, now)
     
+    # attribute write methods must exist when the Device metaclass builds
+    # the Tango class, so they are bound here rather than set afterwards
+    write_period = _make_writer('period')
+    write_low1 = _make_writer('low1')
+    write_high1 = _make_writer('high1')
+    write_delay1 = _make_writer('delay1')
+    write_width1 = _make_writer('width1')
+    write_enabled1 = _make_writer('enabled1')
+    write_cenabled1 = _make_writer('cenabled1')
+    write_low2 = _make_writer('low2')
+    write_high2 = _make_writer('high2')
+    write_delay2 = _make_writer('delay2')
+    write_width2 = _make_writer('width2')
+    write_enabled2 = _make_writer('enabled2')
+    write_cenabled2 = _make_writer('cenabled2')
+    write_trigger_level = _make_writer('trigger_level')
+    write_trigger_mode = _make_writer('trigger_mode')
+    write_trigger_slope = _make_writer('trigger_slope')
+    write_trigger_external = _make_writer('trigger_external')
+
     def delete_device(self):
-        self.dev.close()
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        if self.dev is not None:
+            self.dev.close()
         self.set_state(DevState.OFF)
         self.info_stream('HP8131A device server closed')
 
+    @command(dtype_in=(str,),
+             doc_in='settings as "name=value", e.g. ["period=1e-3", "low1=-0.5"]')
+    async def configure(self, pairs):
+        async with self.batch():
+            for pair in pairs:
+                if '=' not in pair:
+                    raise ValueError(f'Expected "name=value", got {pair!r}')
+                name, text = (s.strip() for s in pair.split('=', 1))
+                if name not in attr2gpib:
+                    raise ValueError(f'Unknown attribute: {name}')
+                value = _from_str(name, text)
+                if name not in _BOOLS and name not in _ENUMS:
+                    self._check_limits(name, value)
+                await getattr(self, f'write_{name}')(value)
+
+    def _check_limits(self, name, value):
+        '''Apply the min/max check Tango does on regular attribute writes'''
+        conf = self.get_attribute_config([name])[0]
+        low = _limit(conf.min_value, float('-inf'))
+        high = _limit(conf.max_value, float('inf'))
+        if not low <= value <= high:
+            raise ValueError(f'{name} = {value} out of range [{low}, {high}]')
+
     @command(doc_in='Simulate single trigger event')
-    def manual_trigger(self):
-        self.write('*TRG')
+    async def manual_trigger(self):
+        await self._write('*TRG')
 
     @command
-    def selftest(self):
-        ans = self.write_read('*TST?')
+    async def selftest(self):
+        ans = await self._query('*TST?', timeout=SELFTEST_TIMEOUT)
+        # settings may have changed during the test, read them again
+        self._cache.clear()
         if ans == '0':
             self.set_state(DevState.ON)
         else: